@@ -2,12 +2,40 @@ import csv
 import json
 import logging
 from datetime import datetime, timedelta
-from supabase import create_client
+from supabase import acreate_client
+from postgrest.types import ReturnMethod
+from postgrest.exceptions import APIError
+import httpx
 import schedule
 import time
 import chardet
 import os
+import hashlib
+import sqlite3
+import asyncio
+import threading
 from collections import defaultdict
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+# Laço de eventos e cliente Supabase reaproveitados entre as execuções agendadas,
+# mantendo o pool de conexões HTTP aberto.
+_event_loop = None
+_supabase_client = None
+_supabase_credentials = None
+
+# Pedidos de sincronização que chegam durante uma execução são agrupados em um só.
+_sync_requested = threading.Event()
+
+# Métricas da execução em andamento (None fora de uma sincronização).
+_run_metrics = None
 
 def setup_logging():
     log_dir = "logs"
@@ -21,16 +49,184 @@ def setup_logging():
         ]
     )
 
-def detect_encoding(file_path):
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class RunMetrics:
+    def __init__(self):
+        self.started_at = datetime.now()
+        self.finished_at = None
+        self.status = "ok"
+        self.error = None
+        self.current_phase = None
+        self.phases = {}
+        self.counters = defaultdict(int)
+        self.tables = defaultdict(lambda: defaultdict(int))
+        self.table_chunks = defaultdict(int)
+        self.latencies = {}
+
+    @contextmanager
+    def phase(self, name):
+        previous = self.current_phase
+        self.current_phase = name
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + time.perf_counter() - start
+        # Em caso de erro a fase atual é mantida para identificar onde a execução parou.
+        self.current_phase = previous
+
+    def observe_request(self, operation, seconds, ok=True):
+        histogram = self.latencies.setdefault(operation, {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0})
+        for position, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                histogram["buckets"][position] += 1
+        histogram["sum"] += seconds
+        histogram["count"] += 1
+        if not ok:
+            self.counters["http_errors"] += 1
+
+    def finish(self):
+        self.finished_at = datetime.now()
+
+    def to_report(self):
+        return {
+            "started_at": self.started_at.isoformat(),
+            "finished_at": self.finished_at.isoformat() if self.finished_at else None,
+            "duration_seconds": round((self.finished_at - self.started_at).total_seconds(), 6) if self.finished_at else None,
+            "status": self.status,
+            "error": self.error,
+            "failed_phase": self.current_phase if self.status == "error" else None,
+            "phases": {name: round(seconds, 6) for name, seconds in self.phases.items()},
+            "counters": dict(self.counters),
+            "tables": {name: dict(counters) for name, counters in self.tables.items()},
+            "table_chunks": dict(self.table_chunks),
+            "latencies": {
+                operation: {
+                    "buckets": dict(zip(map(str, LATENCY_BUCKETS), histogram["buckets"])),
+                    "sum": round(histogram["sum"], 6),
+                    "count": histogram["count"]
+                }
+                for operation, histogram in self.latencies.items()
+            }
+        }
+
+class ServiceMetrics:
+    # Acumula as execuções para o endpoint Prometheus; lido por outra thread.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.runs = defaultdict(int)
+        self.counters = defaultdict(int)
+        self.tables = defaultdict(lambda: defaultdict(int))
+        self.table_chunks = defaultdict(int)
+        self.latencies = {}
+        self.last_run = None
+
+    def record(self, run):
+        with self.lock:
+            self.runs[run.status] += 1
+            for name, value in run.counters.items():
+                self.counters[name] += value
+            for table_name, counters in run.tables.items():
+                for name, value in counters.items():
+                    self.tables[table_name][name] += value
+            for table_name, value in run.table_chunks.items():
+                self.table_chunks[table_name] += value
+            for operation, histogram in run.latencies.items():
+                total = self.latencies.setdefault(operation, {"buckets": [0] * len(LATENCY_BUCKETS), "sum": 0.0, "count": 0})
+                total["buckets"] = [a + b for a, b in zip(total["buckets"], histogram["buckets"])]
+                total["sum"] += histogram["sum"]
+                total["count"] += histogram["count"]
+            self.last_run = run
+
+    def render_prometheus(self):
+        lines = []
+        with self.lock:
+            lines.append("# TYPE siger_sync_runs_total counter")
+            for status, value in self.runs.items():
+                lines.append(f'siger_sync_runs_total{{status="{status}"}} {value}')
+            for name, value in self.counters.items():
+                lines.append(f"# TYPE siger_sync_{name}_total counter")
+                lines.append(f"siger_sync_{name}_total {value}")
+            lines.append("# TYPE siger_sync_table_rows_total counter")
+            for table_name, counters in self.tables.items():
+                for name, value in counters.items():
+                    lines.append(f'siger_sync_table_rows_total{{table="{table_name}",outcome="{name}"}} {value}')
+            lines.append("# TYPE siger_sync_table_chunks_total counter")
+            for table_name, value in self.table_chunks.items():
+                lines.append(f'siger_sync_table_chunks_total{{table="{table_name}"}} {value}')
+            lines.append("# TYPE siger_supabase_request_duration_seconds histogram")
+            for operation, histogram in self.latencies.items():
+                for bound, value in zip(LATENCY_BUCKETS, histogram["buckets"]):
+                    lines.append(f'siger_supabase_request_duration_seconds_bucket{{operation="{operation}",le="{bound}"}} {value}')
+                lines.append(f'siger_supabase_request_duration_seconds_bucket{{operation="{operation}",le="+Inf"}} {histogram["count"]}')
+                lines.append(f'siger_supabase_request_duration_seconds_sum{{operation="{operation}"}} {histogram["sum"]}')
+                lines.append(f'siger_supabase_request_duration_seconds_count{{operation="{operation}"}} {histogram["count"]}')
+            if self.last_run is not None:
+                run = self.last_run
+                lines.append("# TYPE siger_sync_last_run_phase_seconds gauge")
+                for name, seconds in run.phases.items():
+                    lines.append(f'siger_sync_last_run_phase_seconds{{phase="{name}"}} {seconds}')
+                lines.append("# TYPE siger_sync_last_run_duration_seconds gauge")
+                lines.append(f"siger_sync_last_run_duration_seconds {(run.finished_at - run.started_at).total_seconds()}")
+                lines.append("# TYPE siger_sync_last_run_timestamp_seconds gauge")
+                lines.append(f"siger_sync_last_run_timestamp_seconds {run.finished_at.timestamp()}")
+        return "\n".join(lines) + "\n"
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = _service_metrics.render_prometheus().encode('utf-8')
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(host, port):
+    server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-server", daemon=True).start()
+    logging.info(f"Métricas disponíveis em http://{host}:{port}/metrics")
+    return server
+
+def current_metrics():
+    # Fora de uma execução as medições são descartadas.
+    return _run_metrics if _run_metrics is not None else RunMetrics()
+
+_service_metrics = ServiceMetrics()
+
+def write_run_report(report_path, run):
+    try:
+        os.makedirs(os.path.dirname(report_path) or ".", exist_ok=True)
+        with open(report_path, 'a', encoding='utf-8') as file:
+            file.write(json.dumps(run.to_report(), ensure_ascii=False) + "\n")
+    except OSError as e:
+        logging.warning(f"Não foi possível gravar o relatório da execução em {report_path}: {e}")
+
+def detect_encoding(file_path, sample_bytes=64 * 1024):
+    # Só um prefixo limitado é analisado; o cabeçalho do SIGER já traz acentos
+    # suficientes para distinguir UTF-8 de Latin-1.
+    detector = chardet.UniversalDetector()
     with open(file_path, 'rb') as f:
-        result = chardet.detect(f.read())
-        return result['encoding']
+        while not detector.done and f.tell() < sample_bytes:
+            block = f.read(min(8192, sample_bytes - f.tell()))
+            if not block:
+                break
+            detector.feed(block)
+    detector.close()
 
-def load_csv_data(csv_path, required_columns):
-    encoding = detect_encoding(csv_path)
-    logging.info(f"Codificação detectada: {encoding}")
+    encoding = detector.result['encoding']
+    if not encoding or encoding.lower() == 'ascii':
+        return 'utf-8'
+    return encoding
 
-    with open(csv_path, mode='r', encoding=encoding) as file:
+def iter_csv_rows(csv_path, required_columns, encoding):
+    with open(csv_path, mode='r', encoding=encoding, newline='') as file:
         reader = csv.DictReader(file, delimiter=';')
 
         if not reader.fieldnames:
@@ -40,72 +236,625 @@ def load_csv_data(csv_path, required_columns):
         if missing_columns:
             raise ValueError(f"Colunas obrigatórias ausentes no CSV: {missing_columns}")
 
-        return list(reader)
+        yield from reader
 
 def load_config():
     config_path = os.path.join(os.path.dirname(__file__), 'config.json')
     with open(config_path, 'r') as file:
         return json.load(file)
 
-def connect_to_supabase(config):
-    return create_client(config["supabase_url"], config["supabase_service_role_key"])
+def get_event_loop():
+    global _event_loop
+    if _event_loop is None or _event_loop.is_closed():
+        _event_loop = asyncio.new_event_loop()
+    return _event_loop
 
-def organize_csv_by_table(csv_data):
-    organized_data = defaultdict(list)
-    
-    for row in csv_data:
-        if "Cód" in row:
-            organized_data['cliente'].append(row)
-        if "Núm.contrato" in row:
-            organized_data['contrato'].append(row)
-        if "Código" in row:
-            organized_data['produto'].append(row)
+async def count_request_bytes(request):
+    metrics = current_metrics()
+    metrics.counters["http_requests"] += 1
+    metrics.counters["http_bytes_sent"] += len(request.content)
 
-    return organized_data
+async def count_response_bytes(response):
+    await response.aread()
+    current_metrics().counters["http_bytes_received"] += len(response.content)
 
-def fetch_existing_data(supabase):
-    logging.info("Carregando dados existentes do Supabase.")
+async def connect_to_supabase(config):
+    global _supabase_client, _supabase_credentials
+    credentials = (config["supabase_url"], config["supabase_service_role_key"])
+
+    if _supabase_client is None or credentials != _supabase_credentials:
+        if _supabase_client is not None:
+            await _supabase_client.postgrest.aclose()
+        logging.info("Conectando ao Supabase.")
+        _supabase_client = await acreate_client(*credentials)
+        _supabase_client.postgrest.session.event_hooks = {
+            "request": [count_request_bytes],
+            "response": [count_response_bytes]
+        }
+        _supabase_credentials = credentials
+
+    return _supabase_client
 
-    cliente_data = supabase.table('cliente').select('*').execute().data
-    contrato_data = supabase.table('contrato').select('*').execute().data
-    produto_data = supabase.table('produto').select('*').execute().data
+def open_state_store(config):
+    state_path = config.get("state_db_path", os.path.join(os.path.dirname(__file__), 'state.db'))
+    state = sqlite3.connect(state_path)
+    state.executescript("""
+        PRAGMA journal_mode = WAL;
+        PRAGMA synchronous = NORMAL;
+        CREATE TABLE IF NOT EXISTS file_state (
+            path TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            mtime_ns INTEGER NOT NULL,
+            content_hash TEXT NOT NULL,
+            synced_at TEXT NOT NULL,
+            reconciled_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS row_state (
+            table_name TEXT NOT NULL,
+            row_key NOT NULL,
+            fingerprint BLOB NOT NULL,
+            PRIMARY KEY (table_name, row_key)
+        ) WITHOUT ROWID;
+        CREATE TABLE IF NOT EXISTS journal_run (
+            run_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            path TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            planned INTEGER NOT NULL DEFAULT 0,
+            started_at TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS journal_chunk (
+            run_id INTEGER NOT NULL,
+            chunk_no INTEGER NOT NULL,
+            table_name TEXT NOT NULL,
+            status TEXT NOT NULL,
+            payload TEXT NOT NULL,
+            PRIMARY KEY (run_id, chunk_no)
+        );
+        CREATE TABLE IF NOT EXISTS rejected_row (
+            table_name TEXT NOT NULL,
+            row_key NOT NULL,
+            fingerprint BLOB NOT NULL,
+            attempts INTEGER NOT NULL,
+            last_error TEXT NOT NULL,
+            dead INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (table_name, row_key)
+        ) WITHOUT ROWID;
+    """)
+    return state
 
+def file_content_hash(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def load_file_state(state, file_path):
+    row = state.execute(
+        "SELECT size, mtime_ns, content_hash, reconciled_at FROM file_state WHERE path = ?", (file_path,)
+    ).fetchone()
+    if row is None:
+        return None
     return {
-        'cliente': {item['id_siger_cliente']: item for item in cliente_data},
-        'contrato': {item['id_contrato']: item for item in contrato_data},
-        'produto': {item['id_produto_siger']: item for item in produto_data}
+        "size": row[0],
+        "mtime_ns": row[1],
+        "content_hash": row[2],
+        "reconciled_at": datetime.fromisoformat(row[3])
     }
 
-def compare_and_prepare_batches(table_name, csv_data, existing_data, transform_func):
-    new_records = []
-    updated_records = []
-    skipped_records = 0
+def save_file_state(state, file_path, file_stat, content_hash, reconciled_at):
+    with state:
+        state.execute(
+            "INSERT OR REPLACE INTO file_state VALUES (?, ?, ?, ?, ?, ?)",
+            (file_path, file_stat.st_size, file_stat.st_mtime_ns, content_hash,
+             datetime.now().isoformat(), reconciled_at.isoformat())
+        )
 
-    for row in csv_data:
-        record = transform_func(row)
-        unique_key = list(existing_data.keys())[0] if existing_data else None
+def load_row_index(state):
+    index = {table_name: {} for table_name in TABLE_SPECS}
+    for table_name, row_key, fingerprint in state.execute("SELECT table_name, row_key, fingerprint FROM row_state"):
+        if table_name in index:
+            index[table_name][row_key] = fingerprint
+    return index
 
-        if unique_key and record[unique_key] in existing_data:
-            existing_record = existing_data[record[unique_key]]
-            if existing_record != record:
-                updated_records.append(record)
-            else:
-                skipped_records += 1
+def save_row_index(state, table_name, fingerprints, replace=False):
+    with state:
+        if replace:
+            state.execute("DELETE FROM row_state WHERE table_name = ?", (table_name,))
+        state.executemany(
+            "INSERT OR REPLACE INTO row_state VALUES (?, ?, ?)",
+            ((table_name, row_key, fingerprint) for row_key, fingerprint in fingerprints.items())
+        )
+
+def is_reconcile_due(file_state, config):
+    if file_state is None:
+        return True
+    reconcile_hours = config.get("full_reconcile_hours", 24)
+    if not reconcile_hours:
+        return False
+    return datetime.now() - file_state["reconciled_at"] >= timedelta(hours=reconcile_hours)
+
+def record_fingerprint(record, columns):
+    payload = json.dumps([record.get(column) for column in columns], separators=(',', ':'), default=str)
+    return hashlib.blake2b(payload.encode('utf-8'), digest_size=16).digest()
+
+async def fetch_table_index(supabase, table_name, page_size=1000):
+    key = TABLE_SPECS[table_name]["key"]
+    columns = TABLE_SPECS[table_name]["columns"]
+    index = {}
+    last_key = None
+
+    # Paginação por chave: cada página parte da última chave lida, então o limite
+    # max-rows do PostgREST não trunca a leitura. Só uma página fica em memória.
+    while True:
+        query = supabase.table(table_name).select(",".join(columns)).order(key).limit(page_size)
+        if last_key is not None:
+            query = query.gt(key, last_key)
+        start = time.perf_counter()
+        try:
+            page = (await query.execute()).data
+        except Exception:
+            current_metrics().observe_request("select", time.perf_counter() - start, ok=False)
+            raise
+        current_metrics().observe_request("select", time.perf_counter() - start)
+        if not page:
+            break
+        for item in page:
+            index[item[key]] = record_fingerprint(normalize_record(table_name, item), columns)
+        last_key = page[-1][key]
+
+    logging.info(f"Tabela '{table_name}': {len(index)} registros existentes carregados.")
+    return index
+
+async def fetch_existing_data(supabase, page_size=1000):
+    logging.info("Carregando dados existentes do Supabase.")
+
+    indexes = await asyncio.gather(*(
+        fetch_table_index(supabase, table_name, page_size) for table_name in TABLE_SPECS
+    ))
+    return dict(zip(TABLE_SPECS, indexes))
+
+def is_row_rejection(error):
+    # Erros de dados do Postgres (classes 22 e 23: valor inválido, violação de
+    # restrição) dependem do registro enviado; os demais dependem do servidor ou da rede.
+    return isinstance(error, APIError) and str(error.code or "")[:2] in ("22", "23")
+
+# Falhas de servidor ou de rede: o lote fica pendente inteiro e é repetido depois.
+# Inclui 408/429/5xx (respostas sem JSON trazem o status HTTP como código) e os
+# erros de conexão, recursos, timeout e concorrência do Postgres/PostgREST.
+TRANSIENT_SQLSTATE_CLASSES = ("08", "40", "53", "57")
+TRANSIENT_PGRST_CODES = ("PGRST000", "PGRST001", "PGRST002", "PGRST003")
+
+def is_transient_error(error):
+    if isinstance(error, httpx.TransportError):
+        return True
+    if not isinstance(error, APIError):
+        return False
+    code = str(error.code or "")
+    if code.isdigit() and len(code) == 3:
+        return code in ("408", "429") or code.startswith("5")
+    return code[:2] in TRANSIENT_SQLSTATE_CLASSES or code in TRANSIENT_PGRST_CODES
+
+async def upsert_chunk(supabase, table_name, chunk, max_retries, semaphore):
+    # Retorna (rejeitados, com falha, não enviados): rejeitados são pares (registro, erro)
+    # recusados pelo banco e isolados dividindo o lote; com falha são os pares de um
+    # lote recusado inteiro por um erro permanente (autenticação, esquema); não
+    # enviados são os registros de um lote que falhou temporariamente.
+    key = TABLE_SPECS[table_name]["key"]
+    metrics = current_metrics()
+    last_error = None
+
+    for attempt in range(1, max_retries + 1):
+        try:
+            async with semaphore:
+                start = time.perf_counter()
+                try:
+                    await supabase.table(table_name).upsert(
+                        chunk, on_conflict=key, returning=ReturnMethod.minimal
+                    ).execute()
+                finally:
+                    elapsed = time.perf_counter() - start
+            metrics.observe_request("upsert", elapsed)
+            return [], [], []
+        except Exception as e:
+            last_error = e
+            metrics.observe_request("upsert", elapsed, ok=False)
+            logging.warning(
+                f"Falha ao gravar lote de {len(chunk)} registros em '{table_name}' "
+                f"(tentativa {attempt}/{max_retries}): {e}"
+            )
+            if not is_transient_error(e):
+                break
+            if attempt < max_retries:
+                metrics.counters["retries"] += 1
+                await asyncio.sleep(2 ** (attempt - 1))
+
+    # Só uma recusa de dados justifica dividir o lote; qualquer outra falha devolve o
+    # lote inteiro, sem multiplicar as requisições.
+    if is_transient_error(last_error):
+        logging.error(f"Lote de {len(chunk)} registros em '{table_name}' não foi gravado: {last_error}")
+        return [], [], chunk
+    if not is_row_rejection(last_error):
+        logging.error(f"Lote de {len(chunk)} registros em '{table_name}' recusado: {last_error}")
+        return [], [(record, str(last_error)) for record in chunk], []
+
+    if len(chunk) == 1:
+        logging.error(f"Registro rejeitado em '{table_name}': {chunk[0]}")
+        return [(chunk[0], str(last_error))], [], []
+
+    metrics.counters["chunk_splits"] += 1
+    middle = len(chunk) // 2
+    halves = await asyncio.gather(
+        upsert_chunk(supabase, table_name, chunk[:middle], max_retries, semaphore),
+        upsert_chunk(supabase, table_name, chunk[middle:], max_retries, semaphore)
+    )
+    return tuple(first + second for first, second in zip(*halves))
+
+class WriteJournal:
+    # Diário de escrita no state.db: cada lote é registrado antes do envio e
+    # marcado como gravado, junto com o snapshot, na mesma transação do ack.
+    def __init__(self, state, dead_letter_path, dead_letter_attempts=3):
+        self.state = state
+        self.dead_letter_path = dead_letter_path
+        self.dead_letter_attempts = dead_letter_attempts
+        self.run_id = None
+        self.next_chunk_no = 0
+
+    def unfinished_run(self):
+        row = self.state.execute(
+            "SELECT run_id, path, content_hash, planned FROM journal_run ORDER BY run_id DESC LIMIT 1"
+        ).fetchone()
+        if row is None:
+            return None
+        self.run_id = row[0]
+        self.next_chunk_no = self.state.execute(
+            "SELECT COALESCE(MAX(chunk_no) + 1, 0) FROM journal_chunk WHERE run_id = ?", (self.run_id,)
+        ).fetchone()[0]
+        return {"path": row[1], "content_hash": row[2], "planned": bool(row[3])}
+
+    def begin(self, file_path, content_hash):
+        with self.state:
+            self.state.execute("DELETE FROM journal_chunk")
+            self.state.execute("DELETE FROM journal_run")
+            self.run_id = self.state.execute(
+                "INSERT INTO journal_run (path, content_hash, started_at) VALUES (?, ?, ?)",
+                (file_path, content_hash, datetime.now().isoformat())
+            ).lastrowid
+        self.next_chunk_no = 0
+
+    def plan(self, table_name, entries):
+        chunk_no = self.next_chunk_no
+        self.next_chunk_no += 1
+        payload = json.dumps([[record, fingerprint.hex()] for record, fingerprint in entries], ensure_ascii=False)
+        with self.state:
+            self.state.execute(
+                "INSERT INTO journal_chunk (run_id, chunk_no, table_name, status, payload) VALUES (?, ?, ?, 'pending', ?)",
+                (self.run_id, chunk_no, table_name, payload)
+            )
+        return chunk_no
+
+    def mark_planned(self):
+        with self.state:
+            self.state.execute("UPDATE journal_run SET planned = 1 WHERE run_id = ?", (self.run_id,))
+
+    def pending_chunks(self, table_name):
+        rows = self.state.execute(
+            "SELECT chunk_no, payload FROM journal_chunk "
+            "WHERE run_id = ? AND table_name = ? AND status = 'pending' ORDER BY chunk_no",
+            (self.run_id, table_name)
+        ).fetchall()
+        return [
+            (chunk_no, [(record, bytes.fromhex(fingerprint)) for record, fingerprint in json.loads(payload)])
+            for chunk_no, payload in rows
+        ]
+
+    def acknowledge(self, chunk_no, table_name, entries, rejected, failed, unsent):
+        key = TABLE_SPECS[table_name]["key"]
+        rejected_errors = {record[key]: error for record, error in rejected + failed}
+        unsent_keys = {record[key] for record in unsent}
+        committed = {
+            record[key]: fingerprint for record, fingerprint in entries
+            if record[key] not in rejected_errors and record[key] not in unsent_keys
+        }
+
+        # As tentativas são contadas por chave em rejected_row, que sobrevive ao
+        # begin: uma linha recusada chega ao dead-letter mesmo que o export mude.
+        # Se o registro mudou desde a última recusa, a contagem recomeça. Os registros
+        # de um lote recusado inteiro por erro permanente contam do mesmo jeito.
+        rejections = []
+        dead_letters = []
+        for record, fingerprint in entries:
+            row_key = record[key]
+            if row_key not in rejected_errors:
+                continue
+            previous = self.state.execute(
+                "SELECT fingerprint, attempts FROM rejected_row WHERE table_name = ? AND row_key = ?",
+                (table_name, row_key)
+            ).fetchone()
+            attempts = previous[1] + 1 if previous is not None and previous[0] == fingerprint else 1
+            dead = attempts >= self.dead_letter_attempts
+            rejections.append((table_name, row_key, fingerprint, attempts, rejected_errors[row_key], int(dead)))
+            if dead:
+                dead_letters.append((record, rejected_errors.pop(row_key), attempts))
+
+        remaining = [
+            (record, fingerprint) for record, fingerprint in entries
+            if record[key] in rejected_errors or record[key] in unsent_keys
+        ]
+        if remaining:
+            status = 'pending'
+        else:
+            status = 'dead' if dead_letters else 'committed'
+        payload = json.dumps([[record, fingerprint.hex()] for record, fingerprint in remaining], ensure_ascii=False)
+
+        if dead_letters:
+            self.write_dead_letters(table_name, chunk_no, dead_letters)
+        with self.state:
+            self.state.execute(
+                "UPDATE journal_chunk SET status = ?, payload = ? WHERE run_id = ? AND chunk_no = ?",
+                (status, payload, self.run_id, chunk_no)
+            )
+            self.state.executemany("INSERT OR REPLACE INTO rejected_row VALUES (?, ?, ?, ?, ?, ?)", rejections)
+            self.state.executemany(
+                "DELETE FROM rejected_row WHERE table_name = ? AND row_key = ?",
+                ((table_name, row_key) for row_key in committed)
+            )
+            save_row_index(self.state, table_name, committed)
+        return len(committed), len(dead_letters)
+
+    def dead_rows(self, table_name):
+        # Linhas já enviadas ao dead-letter: só voltam a ser enviadas se o registro mudar.
+        return dict(self.state.execute(
+            "SELECT row_key, fingerprint FROM rejected_row WHERE table_name = ? AND dead = 1", (table_name,)
+        ))
+
+    def write_dead_letters(self, table_name, chunk_no, dead_letters):
+        os.makedirs(os.path.dirname(self.dead_letter_path) or ".", exist_ok=True)
+        with open(self.dead_letter_path, 'a', encoding='utf-8') as file:
+            for record, error, attempts in dead_letters:
+                file.write(json.dumps({
+                    "at": datetime.now().isoformat(),
+                    "table": table_name,
+                    "run_id": self.run_id,
+                    "chunk_no": chunk_no,
+                    "attempts": attempts,
+                    "error": error,
+                    "record": record
+                }, ensure_ascii=False) + "\n")
+        logging.error(
+            f"{len(dead_letters)} registros de '{table_name}' enviados para {self.dead_letter_path} "
+            f"após {self.dead_letter_attempts} tentativas."
+        )
+
+    def pending_count(self):
+        return self.state.execute(
+            "SELECT COUNT(*) FROM journal_chunk WHERE run_id = ? AND status = 'pending'", (self.run_id,)
+        ).fetchone()[0]
+
+    def finish(self):
+        with self.state:
+            self.state.execute("DELETE FROM journal_chunk WHERE run_id = ?", (self.run_id,))
+            self.state.execute("DELETE FROM journal_run WHERE run_id = ?", (self.run_id,))
+        self.run_id = None
+
+async def write_journaled_chunk(supabase, journal, chunk_no, table_name, entries, max_retries, semaphore):
+    rejected, failed, unsent = await upsert_chunk(
+        supabase, table_name, [record for record, _ in entries], max_retries, semaphore
+    )
+    written, dead = journal.acknowledge(chunk_no, table_name, entries, rejected, failed, unsent)
+    metrics = current_metrics()
+    metrics.counters["rows_dead_lettered"] += dead
+    if unsent:
+        metrics.counters["chunks_unsent"] += 1
+    if failed:
+        metrics.counters["chunks_failed"] += 1
+    return written, len(entries) - written, len(unsent)
+
+async def resume_journal(supabase, journal, semaphore, max_retries):
+    # Reenvia, na ordem das chaves estrangeiras, os lotes que a execução anterior
+    # registrou mas não confirmou. O upsert é idempotente, então repetir é seguro.
+    resumed = 0
+    blocked = False
+    for table_name in TABLE_SPECS:
+        chunks = journal.pending_chunks(table_name)
+        if not chunks:
+            continue
+        if blocked:
+            # Uma tabela pai ainda tem lotes não enviados: os filhos esperariam
+            # pelas chaves estrangeiras e seriam recusados.
+            logging.warning(f"{len(chunks)} lotes de '{table_name}' aguardam as tabelas pai.")
+            continue
+        logging.info(f"Retomando {len(chunks)} lotes pendentes de '{table_name}'.")
+        key = TABLE_SPECS[table_name]["key"]
+        keys = [record[key] for _, entries in chunks for record, _ in entries]
+        if len(keys) == len(set(keys)):
+            results = await asyncio.gather(*(
+                write_journaled_chunk(supabase, journal, chunk_no, table_name, entries, max_retries, semaphore)
+                for chunk_no, entries in chunks
+            ))
         else:
-            new_records.append(record)
+            # A mesma chave em lotes diferentes: mantém a ordem original para a última versão prevalecer.
+            results = []
+            for chunk_no, entries in chunks:
+                results.append(await write_journaled_chunk(
+                    supabase, journal, chunk_no, table_name, entries, max_retries, semaphore
+                ))
+        blocked = any(unsent for _, _, unsent in results)
+        resumed += len(chunks)
+    current_metrics().counters["chunks_resumed"] += resumed
+    return resumed
+
+class TableSink:
+    def __init__(self, supabase, table_name, existing_index, parents, journal, semaphore, batch_size=500, max_retries=3):
+        self.supabase = supabase
+        self.table_name = table_name
+        self.spec = TABLE_SPECS[table_name]
+        self.existing_index = existing_index
+        self.parents = parents
+        self.journal = journal
+        self.dead_index = journal.dead_rows(table_name)
+        self.semaphore = semaphore
+        self.batch_size = batch_size
+        self.max_retries = max_retries
+        self.pending = {}
+        self.seen = {}
+        self.open_key = None
+        self.open_entry = None
+        self.tasks = []
+        self.resending = False
+        self.new_count = 0
+        self.updated_count = 0
+        self.skipped_count = 0
+        self.invalid_count = 0
+        self.written_count = 0
+        self.failed_count = 0
+        self.unsent_count = 0
+        self.chunk_count = 0
+        self.first_write_at = None
+        self.last_write_at = None
 
-    logging.info(f"Tabela '{table_name}': {len(new_records)} novos, {len(updated_records)} atualizados, {skipped_records} ignorados.")
-    return new_records, updated_records
+    def add(self, row):
+        try:
+            record = convert_record(self.table_name, self.spec["transform"](row))
+        except (KeyError, ValueError, AttributeError, TypeError) as e:
+            # Linhas truncadas chegam do DictReader com None nos campos que faltam.
+            self.invalid_count += 1
+            logging.debug(f"Linha inválida para '{self.table_name}': {e}")
+            return False
+
+        # Os conversores valem também para o registro enviado; os normalizadores só para a comparação.
+        key = record[self.spec["key"]]
+        fingerprint = record_fingerprint(normalize_record(self.table_name, record), self.spec["columns"])
+
+        # O export repete cliente e contrato em linhas consecutivas de item, e o status
+        # pode variar entre elas: a chave só é classificada quando o grupo de linhas
+        # termina, valendo a última linha, como no snapshot.
+        if key != self.open_key:
+            self.close_group()
+            self.open_key = key
+        self.open_entry = (record, fingerprint)
+
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+            return True
+        return False
+
+    def close_group(self):
+        if self.open_key is None:
+            return
+        key = self.open_key
+        record, fingerprint = self.open_entry
+        self.open_key = self.open_entry = None
+
+        previous = self.seen.get(key)
+        if previous == fingerprint:
+            return
+        self.seen[key] = fingerprint
+
+        if previous is None:
+            existing = self.existing_index.get(key)
+            if existing == fingerprint or self.dead_index.get(key) == fingerprint:
+                self.skipped_count += 1
+                return
+            if existing is None:
+                self.new_count += 1
+            else:
+                self.updated_count += 1
+        elif key not in self.pending:
+            self.resending = True
+
+        self.pending[key] = (record, fingerprint)
+
+    def settle(self):
+        # Um lote filho pode referenciar a chave do grupo ainda aberto. Se ela ainda não
+        # existe no servidor, a versão atual é enviada já; se o grupo terminar com outro
+        # valor, a chave é reenviada e a última versão prevalece.
+        if self.open_key is None or self.open_key in self.existing_index or self.open_key in self.seen:
+            return
+        key, entry = self.open_key, self.open_entry
+        self.close_group()
+        self.open_key, self.open_entry = key, entry
+
+    def in_flight(self):
+        return [task for task in self.tasks if not task.done()]
+
+    def flush(self):
+        if not self.pending:
+            return
+
+        # Chaves estrangeiras: o que está pendente nas tabelas pai é enviado antes,
+        # e este lote só é gravado depois que os lotes pai em andamento terminarem.
+        for parent in self.parents:
+            parent.settle()
+            parent.flush()
+        dependencies = [task for parent in self.parents for task in parent.in_flight()]
+        if self.resending:
+            # Uma chave já enviada mudou mais adiante no arquivo: espera os lotes
+            # anteriores da própria tabela para que a última versão prevaleça.
+            dependencies += self.in_flight()
+            self.resending = False
+
+        entries = list(self.pending.values())
+        self.pending = {}
+        chunk_no = self.journal.plan(self.table_name, entries)
+        self.tasks.append(asyncio.ensure_future(self.write_chunk(chunk_no, entries, dependencies)))
+        self.chunk_count += 1
+
+    async def write_chunk(self, chunk_no, entries, dependencies):
+        if dependencies:
+            await asyncio.wait(dependencies)
+
+        if any(parent.unsent_count for parent in self.parents):
+            # A tabela pai tem lotes não enviados por falha temporária: este lote fica
+            # pendente no diário em vez de ser recusado pela chave estrangeira e contar
+            # para o dead-letter. Falhas permanentes não seguram as tabelas filhas.
+            self.failed_count += len(entries)
+            self.unsent_count += len(entries)
+            return
+
+        if self.first_write_at is None:
+            self.first_write_at = time.perf_counter()
+        written, failed, unsent = await write_journaled_chunk(
+            self.supabase, self.journal, chunk_no, self.table_name, entries, self.max_retries, self.semaphore
+        )
+        self.last_write_at = time.perf_counter()
+        self.written_count += written
+        self.failed_count += failed
+        self.unsent_count += unsent
+
+    async def close(self):
+        self.close_group()
+        self.flush()
+        await asyncio.gather(*self.tasks)
+
+    def cancel(self):
+        for task in self.in_flight():
+            task.cancel()
 
-def sync_batches(supabase, table_name, new_records, updated_records):
-    if new_records:
-        supabase.table(table_name).insert(new_records).execute()
-        logging.info(f"Inseridos {len(new_records)} novos registros em '{table_name}'.")
-    if updated_records:
-        for record in updated_records:
-            unique_key = list(record.keys())[0]
-            supabase.table(table_name).update(record).eq(unique_key, record[unique_key]).execute()
-        logging.info(f"Atualizados {len(updated_records)} registros em '{table_name}'.")
+    def record_metrics(self, metrics):
+        counters = metrics.tables[self.table_name]
+        counters["new"] += self.new_count
+        counters["updated"] += self.updated_count
+        counters["skipped"] += self.skipped_count
+        counters["invalid"] += self.invalid_count
+        counters["written"] += self.written_count
+        counters["failed"] += self.failed_count
+        metrics.table_chunks[self.table_name] += self.chunk_count
+        if self.first_write_at is not None:
+            metrics.phases[f"write_{self.table_name}"] = self.last_write_at - self.first_write_at
+
+    def log_summary(self):
+        logging.info(
+            f"Tabela '{self.table_name}': {self.new_count} novos, {self.updated_count} atualizados, "
+            f"{self.skipped_count} ignorados, {self.invalid_count} linhas inválidas."
+        )
+        if self.first_write_at is not None:
+            elapsed = self.last_write_at - self.first_write_at
+            rate = self.written_count / elapsed if elapsed > 0 else float(self.written_count)
+            logging.info(
+                f"Tabela '{self.table_name}': {self.written_count} registros gravados em {self.chunk_count} lotes "
+                f"({elapsed:.2f}s, {rate:.0f} registros/s), {self.failed_count} com falha."
+            )
 
 def transform_cliente(row):
     return {
@@ -135,50 +884,351 @@ def transform_produto(row):
         "ativo": row.get("Descr.Sit.item cont.(enumerado)", "").strip().lower() == "ativo"
     }
 
-def sync_data():
+def normalize_text(value):
+    if value is None:
+        return None
+    value = str(value).strip()
+    return value or None
+
+def normalize_date(value):
+    value = normalize_text(value)
+    if value is None:
+        return None
+    for date_format in ("%d/%m/%Y", "%Y-%m-%d"):
+        try:
+            return datetime.strptime(value[:10], date_format).date().isoformat()
+        except ValueError:
+            continue
+    return value
+
+def convert_record(table_name, record):
+    converters = TABLE_SPECS[table_name]["converters"]
+    return {
+        column: converters[column](value) if column in converters else value
+        for column, value in record.items()
+    }
+
+def normalize_record(table_name, record):
+    spec = TABLE_SPECS[table_name]
+    normalizers = {**spec["converters"], **spec["normalizers"]}
+    return {
+        column: normalizers[column](value) if column in normalizers else value
+        for column, value in record.items()
+    }
+
+# Ordem de declaração = ordem de dependência das chaves estrangeiras.
+# "converters" ajustam o valor enviado ao formato da coluna (datas do export em
+# dd/mm/aaaa viram ISO); "normalizers" só entram na impressão digital.
+TABLE_SPECS = {
+    'cliente': {
+        "key": "id_siger_cliente",
+        "columns": ["id_siger_cliente", "nome_cliente", "cnpj", "deletado"],
+        "converters": {},
+        "normalizers": {"nome_cliente": normalize_text, "cnpj": normalize_text},
+        "transform": transform_cliente,
+        "parents": []
+    },
+    'contrato': {
+        "key": "id_contrato",
+        "columns": ["id_contrato", "id_siger_cliente", "dt_inic_cont", "dt_vig_inic", "dt_vig_final", "deletado"],
+        "converters": {"dt_inic_cont": normalize_date, "dt_vig_inic": normalize_date, "dt_vig_final": normalize_date},
+        "normalizers": {},
+        "transform": transform_contrato,
+        "parents": ["cliente"]
+    },
+    'produto': {
+        "key": "id_produto_siger",
+        "columns": ["id_produto_siger", "nome_produto", "tipo_produto", "num_serie", "num_lote", "ativo"],
+        "converters": {},
+        "normalizers": {
+            "nome_produto": normalize_text, "tipo_produto": normalize_text,
+            "num_serie": normalize_text, "num_lote": normalize_text
+        },
+        "transform": transform_produto,
+        "parents": ["contrato"]
+    }
+}
+
+def sync_data(config=None):
+    get_event_loop().run_until_complete(sync_data_async(config))
+
+async def sync_data_async(config=None):
+    global _run_metrics
     logging.info("Iniciando sincronização dos dados.")
     start_time = datetime.now()
+    metrics = _run_metrics = RunMetrics()
 
     try:
-        config = load_config()
-        supabase = connect_to_supabase(config)
+        with metrics.phase("config_load"):
+            if config is None:
+                config = load_config()
+        csv_path = config["csv_file_path"]
+        state = open_state_store(config)
+        try:
+            if await sync_from_snapshot(config, state, csv_path, metrics):
+                end_time = datetime.now()
+                elapsed_time = str(timedelta(seconds=(end_time - start_time).total_seconds()))
+                if metrics.status == "partial":
+                    logging.warning(f"Sincronização concluída parcialmente em {elapsed_time}.")
+                else:
+                    logging.info(f"Sincronização concluída em {elapsed_time}.")
+            else:
+                metrics.status = "skipped"
+        finally:
+            state.close()
+    except Exception as e:
+        metrics.status = "error"
+        metrics.error = f"{type(e).__name__}: {e}"
+        logging.exception(f"Erro durante a sincronização (fase '{metrics.current_phase}'): {e}")
+    finally:
+        _run_metrics = None
+        metrics.finish()
+        _service_metrics.record(metrics)
+        write_run_report((config or {}).get("run_report_path", os.path.join("logs", "run_report.jsonl")), metrics)
 
-        required_columns = [
-            "Cód", "Razão social", "CNPJ/CPF",
-            "Núm.contrato", "Dt.inc.cont", "Dt.vig.inic", "Dt.vig.final",
-            "Código", "Desc.item", "Descrição"
-        ]
+async def sync_from_snapshot(config, state, csv_path, metrics):
+    with metrics.phase("change_check"):
+        file_stat = os.stat(csv_path)
+        file_state = load_file_state(state, csv_path)
+        reconcile = is_reconcile_due(file_state, config)
 
-        csv_data = load_csv_data(config["csv_file_path"], required_columns)
-        organized_data = organize_csv_by_table(csv_data)
-        existing_data = fetch_existing_data(supabase)
+        if not reconcile and (file_stat.st_size, file_stat.st_mtime_ns) == (file_state["size"], file_state["mtime_ns"]):
+            logging.info("Arquivo CSV sem alterações desde a última sincronização.")
+            return False
 
-        for table_name, csv_rows in organized_data.items():
-            new_records, updated_records = compare_and_prepare_batches(
-                table_name, csv_rows, existing_data.get(table_name, {}), globals()[f"transform_{table_name}"]
-            )
-            sync_batches(supabase, table_name, new_records, updated_records)
+        content_hash = file_content_hash(csv_path)
+        if not reconcile and content_hash == file_state["content_hash"]:
+            save_file_state(state, csv_path, file_stat, content_hash, file_state["reconciled_at"])
+            logging.info("Conteúdo do CSV sem alterações desde a última sincronização.")
+            return False
 
-        end_time = datetime.now()
-        elapsed_time = str(timedelta(seconds=(end_time - start_time).total_seconds()))
-        logging.info(f"Sincronização concluída em {elapsed_time}.")
-    except Exception as e:
-        logging.error(f"Erro durante a sincronização: {e}")
+    with metrics.phase("connect"):
+        supabase = await connect_to_supabase(config)
+
+    max_concurrency = config.get("max_concurrency", 4)
+    max_retries = config.get("max_retries", 3)
+    semaphore = asyncio.Semaphore(max_concurrency)
+    journal = WriteJournal(
+        state, config.get("dead_letter_path", os.path.join("logs", "dead_letter.jsonl")),
+        config.get("dead_letter_attempts", 3)
+    )
+
+    unfinished = journal.unfinished_run()
+    if unfinished is not None:
+        with metrics.phase("resume"):
+            await resume_journal(supabase, journal, semaphore, max_retries)
+        if unfinished["planned"] and (unfinished["path"], unfinished["content_hash"]) == (csv_path, content_hash):
+            # Mesmo arquivo da execução interrompida, que já tinha todos os lotes
+            # registrados: não é preciso reler o CSV nem refazer o diff.
+            reconciled_at = file_state["reconciled_at"] if file_state else datetime.now()
+            return complete_journal(state, journal, csv_path, file_stat, content_hash, reconciled_at, metrics)
+        # Caso contrário o plano antigo é descartado; o diff contra o snapshot, que
+        # já contém os lotes confirmados, só reenvia o que ainda falta.
+
+    required_columns = [
+        "Cód", "Razão social", "CNPJ/CPF",
+        "Núm.contrato", "Dt.inc.cont", "Dt.vig.inic", "Dt.vig.final",
+        "Código", "Desc.item", "Descrição"
+    ]
+
+    if reconcile:
+        logging.info("Executando reconciliação completa com o Supabase.")
+        with metrics.phase("remote_fetch"):
+            existing_data = await fetch_existing_data(supabase, config.get("fetch_page_size", 1000))
+            for table_name, index in existing_data.items():
+                save_row_index(state, table_name, index, replace=True)
+        reconciled_at = datetime.now()
+    else:
+        with metrics.phase("snapshot_load"):
+            existing_data = load_row_index(state)
+        reconciled_at = file_state["reconciled_at"]
+
+    encoding = config.get("csv_encoding")
+    if encoding:
+        logging.info(f"Codificação configurada: {encoding}")
+    else:
+        with metrics.phase("encoding_detection"):
+            encoding = detect_encoding(csv_path, config.get("encoding_sample_bytes", 64 * 1024))
+        logging.info(f"Codificação detectada: {encoding}")
+
+    journal.begin(csv_path, content_hash)
+    sinks = {}
+    for table_name, spec in TABLE_SPECS.items():
+        sinks[table_name] = TableSink(
+            supabase, table_name, existing_data[table_name],
+            [sinks[parent] for parent in spec["parents"]],
+            journal, semaphore, config.get("batch_size", 500), max_retries
+        )
+
+    rows_read = 0
+    diff_seconds = 0.0
+    backpressure_seconds = 0.0
+    try:
+        # Leitura, diff e envio se sobrepõem: o tempo de transformação e diff e o
+        # tempo cedido aos envios são medidos à parte e descontados da leitura do CSV.
+        parse_start = time.perf_counter()
+        with metrics.phase("csv_parse"):
+            for row in iter_csv_rows(csv_path, required_columns, encoding):
+                rows_read += 1
+                flushed = False
+                diff_start = time.perf_counter()
+                for sink in sinks.values():
+                    flushed = sink.add(row) or flushed
+                diff_seconds += time.perf_counter() - diff_start
+                if flushed:
+                    # Cede o laço para os envios começarem e limita os lotes em memória
+                    # quando a leitura é mais rápida que a rede.
+                    wait_start = time.perf_counter()
+                    in_flight = [task for sink in sinks.values() for task in sink.in_flight()]
+                    if len(in_flight) >= max_concurrency * 2:
+                        await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                    else:
+                        await asyncio.sleep(0)
+                    backpressure_seconds += time.perf_counter() - wait_start
+        metrics.phases["csv_parse"] = time.perf_counter() - parse_start - diff_seconds - backpressure_seconds
+        metrics.phases["diff"] = diff_seconds
+        metrics.phases["write_backpressure"] = backpressure_seconds
+        metrics.counters["rows_read"] += rows_read
+        logging.info(f"Lidas {rows_read} linhas do CSV.")
+
+        with metrics.phase("write_drain"):
+            for sink in sinks.values():
+                await sink.close()
+        journal.mark_planned()
+    except BaseException:
+        for sink in sinks.values():
+            sink.cancel()
+        raise
+
+    for sink in sinks.values():
+        sink.log_summary()
+        sink.record_metrics(metrics)
+
+    return complete_journal(state, journal, csv_path, file_stat, content_hash, reconciled_at, metrics)
+
+def complete_journal(state, journal, csv_path, file_stat, content_hash, reconciled_at, metrics):
+    # Com lotes pendentes o estado do arquivo não é gravado, para que a próxima
+    # execução retome o diário a partir do primeiro lote não confirmado.
+    pending = journal.pending_count()
+    if pending:
+        logging.warning(f"{pending} lotes não foram confirmados; serão retomados na próxima execução.")
+    else:
+        save_file_state(state, csv_path, file_stat, content_hash, reconciled_at)
+        journal.finish()
+
+    # Lotes pendentes ou registros no dead-letter: a execução terminou, mas não gravou tudo.
+    if pending or metrics.counters.get("rows_dead_lettered"):
+        metrics.status = "partial"
+    return True
+
+def request_sync(reason):
+    if _sync_requested.is_set():
+        logging.debug(f"Sincronização já pendente; pedido agrupado ({reason}).")
+        return
+    logging.info(f"Sincronização solicitada: {reason}.")
+    _sync_requested.set()
+
+def sync_worker():
+    # Única thread que executa sincronizações: nunca há duas ao mesmo tempo.
+    while True:
+        _sync_requested.wait()
+        _sync_requested.clear()
+        try:
+            sync_data()
+        except Exception as e:
+            logging.error(f"Erro na execução da sincronização: {e}")
+
+class CsvEventHandler(FileSystemEventHandler):
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        paths = {getattr(event, 'src_path', None), getattr(event, 'dest_path', None)}
+        if self.watcher.csv_path in {os.path.abspath(path) for path in paths if path}:
+            self.watcher.changed.set()
+
+class CsvWatcher:
+    def __init__(self, csv_path, debounce_seconds=5):
+        self.csv_path = os.path.abspath(csv_path)
+        self.debounce_seconds = debounce_seconds
+        self.changed = threading.Event()
+        self.signature = self.stat_signature()
+        self.changed_at = None
+        self.observer = None
+
+        if Observer is not None:
+            self.observer = Observer()
+            self.observer.schedule(CsvEventHandler(self), os.path.dirname(self.csv_path))
+            self.observer.daemon = True
+            self.observer.start()
+
+    def stat_signature(self):
+        try:
+            file_stat = os.stat(self.csv_path)
+        except FileNotFoundError:
+            return None
+        return file_stat.st_size, file_stat.st_mtime_ns
+
+    def wait(self, timeout):
+        # Com watchdog (inotify) o evento acorda o laço na hora; sem ele, o
+        # stat a cada volta do laço faz o papel de polling.
+        self.changed.wait(timeout)
+        self.changed.clear()
+
+    def poll(self):
+        signature = self.stat_signature()
+        now = time.monotonic()
+
+        if signature != self.signature:
+            self.signature = signature
+            self.changed_at = now
+            return False
+
+        # Só dispara quando o arquivo existe e ficou estável pelo tempo de debounce,
+        # evitando ler um export ainda sendo gravado.
+        if self.changed_at is not None and signature is not None and now - self.changed_at >= self.debounce_seconds:
+            self.changed_at = None
+            return True
+        return False
 
 def start_service():
     config = load_config()
     interval = config["update_interval_minutes"]
-    logging.info(f"Serviço iniciado. Atualização programada a cada {interval} minutos.")
+    watch_mode = config.get("schedule_mode", "interval") == "watch"
+
+    threading.Thread(target=sync_worker, name="sync-worker", daemon=True).start()
 
-    schedule.every(interval).minutes.do(sync_data)
+    watcher = None
+    if watch_mode:
+        watcher = CsvWatcher(config["csv_file_path"], config.get("debounce_seconds", 5))
+        method = "watchdog" if watcher.observer else "polling"
+        logging.info(
+            f"Serviço iniciado. Monitorando {config['csv_file_path']} ({method}); "
+            f"sincronização de segurança a cada {interval} minutos."
+        )
+    else:
+        logging.info(f"Serviço iniciado. Atualização programada a cada {interval} minutos.")
+
+    if config.get("metrics_port"):
+        start_metrics_server(config.get("metrics_host", "127.0.0.1"), config["metrics_port"])
+
+    schedule.every(interval).minutes.do(request_sync, "intervalo programado")
+    request_sync("início do serviço")
 
     while True:
         try:
             schedule.run_pending()
+            if watcher is not None and watcher.poll():
+                request_sync("arquivo CSV alterado")
         except Exception as e:
             logging.error(f"Erro no loop de agendamento: {e}")
-        time.sleep(1)
 
-if __name__ == "_main_":
+        if watcher is not None:
+            watcher.wait(1)
+        else:
+            time.sleep(1)
+
+if __name__ == "__main__":
     setup_logging()
-    start_service()
\ No newline at end of file
+    start_service()